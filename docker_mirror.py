@@ -8,19 +8,36 @@ Docker镜像镜像工具 - Python版本
 支持从.env文件或环境变量加载配置
 """
 
+import argparse
+import json
 import os
+import queue
 import sys
-import subprocess
 import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 import logging
-import colorama
-from colorama import Fore, Style
+import docker
+import requests
+from requests.adapters import HTTPAdapter
+from docker.errors import APIError, ImageNotFound
 from dotenv import load_dotenv
+from urllib3.util.retry import Retry
 
-# 初始化colorama
-colorama.init()
+# ANSI颜色，输出不是终端（如CI日志）时不添加颜色
+_USE_COLOR = sys.stdout.isatty()
+_CYAN = "\x1b[36m" if _USE_COLOR else ""
+_BLUE = "\x1b[34m" if _USE_COLOR else ""
+_YELLOW = "\x1b[33m" if _USE_COLOR else ""
+_RED = "\x1b[31m" if _USE_COLOR else ""
+_BRIGHT = "\x1b[1m" if _USE_COLOR else ""
+_RESET = "\x1b[0m" if _USE_COLOR else ""
 
 # 配置日志
 logging.basicConfig(
@@ -33,16 +50,22 @@ class ColoredFormatter(logging.Formatter):
     """自定义日志格式化器，添加颜色"""
 
     FORMATS = {
-        logging.DEBUG: Fore.CYAN + "[DEBUG] " + Fore.RESET + "%(message)s",
-        logging.INFO: Fore.BLUE + "[INFO] " + Fore.RESET + "%(message)s",
-        logging.WARNING: Fore.YELLOW + "[WARNING] " + Fore.RESET + "%(message)s",
-        logging.ERROR: Fore.RED + "[ERROR] " + Fore.RESET + "%(message)s",
-        logging.CRITICAL: Fore.RED + Style.BRIGHT + "[CRITICAL] " + Style.RESET_ALL + "%(message)s",
+        logging.DEBUG: _CYAN + "[DEBUG] " + _RESET + "%(message)s",
+        logging.INFO: _BLUE + "[INFO] " + _RESET + "%(message)s",
+        logging.WARNING: _YELLOW + "[WARNING] " + _RESET + "%(message)s",
+        logging.ERROR: _RED + "[ERROR] " + _RESET + "%(message)s",
+        logging.CRITICAL: _RED + _BRIGHT + "[CRITICAL] " + _RESET + "%(message)s",
     }
 
+    def __init__(self):
+        super().__init__()
+        # 每个级别的格式化器只创建一次
+        self._formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
         return formatter.format(record)
 
 # 获取logger并设置格式化器
@@ -50,14 +73,118 @@ logger = logging.getLogger()
 for handler in logger.handlers:
     handler.setFormatter(ColoredFormatter())
 
+class MirrorError(Exception):
+    """镜像工具的基础异常"""
+
+class ConfigError(MirrorError):
+    """配置错误，例如缺少环境变量或镜像列表文件"""
+
+class MirrorRuntimeError(MirrorError):
+    """运行时错误，例如登录失败或镜像处理失败"""
+
+@dataclass
+class ImageSpec:
+    """镜像列表中单行解析后的镜像信息"""
+
+    raw: str
+    image: str
+    platform: str
+    parts: List[str]
+    image_name_tag: str
+    image_name: str
+    name_space: str
+    # 目标镜像名的平台前缀与重名时的命名空间前缀
+    platform_prefix: str = ""
+    name_space_prefix: str = ""
+
 class DockerMirror:
     """Docker镜像镜像工具类"""
 
-    def __init__(self):
+    # 必要的环境变量：(属性名, 环境变量名)
+    REQUIRED_ENV = (
+        ('registry', 'ALIYUN_REGISTRY'),
+        ('namespace', 'ALIYUN_NAME_SPACE'),
+        ('username', 'ALIYUN_REGISTRY_USER'),
+        ('password', 'ALIYUN_REGISTRY_PASSWORD'),
+    )
+
+    registry: str
+    namespace: str
+    username: str
+    password: str
+
+    # 平台参数，例如 --platform=linux/arm64
+    _PLATFORM_RE = re.compile(r'--platform[ =](\S+)')
+
+    # 查询镜像清单时接受的类型，包含单平台清单和多平台索引
+    MANIFEST_LIST_TYPES = (
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.index.v1+json",
+    )
+    MANIFEST_TYPES = (
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+    ) + MANIFEST_LIST_TYPES
+
+    # 访问镜像仓库API的超时时间（秒）
+    REGISTRY_TIMEOUT = 10
+    # Bearer token 最长缓存时间（秒）
+    TOKEN_TTL = 300
+
+    # 拉取、推送进度的输出间隔（秒），以及表示单层传输中/完成的状态
+    PROGRESS_INTERVAL = 1.0
+    # 超过该时间（秒）未收到任何数据时认为传输停滞并告警
+    STALL_TIMEOUT = 30.0
+    LAYER_TRANSFER_STATUSES = ("Downloading", "Pushing")
+    LAYER_DONE_STATUSES = ("Download complete", "Pull complete", "Already exists", "Pushed", "Layer already exists")
+
+    # 累计多少个待删除镜像后统一清理
+    REMOVE_BATCH_SIZE = 10
+    # Docker数据目录剩余空间低于该值时立即清理（字节）
+    MIN_FREE_BYTES = 5 * 1024 ** 3
+
+    # Docker守护进程配置文件，以及层并发传输数的默认值与建议值
+    DAEMON_CONFIG = "/etc/docker/daemon.json"
+    DAEMON_TRANSFER_DEFAULTS = {
+        "max-concurrent-downloads": 3,
+        "max-concurrent-uploads": 5,
+    }
+    RECOMMENDED_CONCURRENT_TRANSFERS = 10
+
+    # 默认并发数，略低于Docker守护进程默认的 max-concurrent-uploads(5)
+    DEFAULT_PARALLEL = 4
+
+    def __init__(self, parallel: Optional[int] = None):
         """初始化Docker镜像镜像工具"""
         self.load_env()
         self.images_file = "images.txt"
         self.duplicate_images: Set[str] = set()
+        # 解析后的镜像列表，首次解析后缓存
+        self._specs: Optional[List[ImageSpec]] = None
+        self.parallel = parallel if parallel else self.load_parallel()
+        # 是否在本地保留按摘要固定的源镜像，供同一主机之后的运行复用
+        self.keep_pinned = os.getenv('MIRROR_KEEP_PINNED', '').lower() in ('1', 'true', 'yes')
+        # 复用同一个Docker客户端，连接池不小于并发数
+        self.client = docker.from_env(max_pool_size=max(self.parallel, 10))
+        # 复用HTTP连接访问镜像仓库API，避免每次请求重新握手
+        self._http = requests.Session()
+        self._http.mount('https://', HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=max(self.parallel, 20),
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+        ))
+        # 镜像仓库的Bearer token及过期时间，按 (仓库地址, 仓库路径) 缓存
+        self._tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._daemon_platform: Optional[str] = None
+        # 待删除的本地镜像，多个线程共享，需要加锁访问
+        self._to_remove: Set[str] = set()
+        self._remove_lock = threading.Lock()
+        # 同一源镜像的拉取与标记需要串行，按规范化后的镜像引用加锁
+        self._source_locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+        self._source_locks_guard = threading.Lock()
+        self._docker_root: Optional[str] = None
+        # 是否可以使用 docker buildx imagetools 在仓库之间直接复制镜像
+        self.use_buildx = False
 
     def load_env(self) -> None:
         """加载环境变量"""
@@ -68,219 +195,625 @@ class DockerMirror:
             load_dotenv(env_path)
 
         # 检查必要的环境变量
+        environ = os.environ
         missing_vars = []
+        for attr, var in self.REQUIRED_ENV:
+            value = environ.get(var)
+            if not value:
+                missing_vars.append(var)
+            setattr(self, attr, value)
 
-        self.registry = os.getenv('ALIYUN_REGISTRY')
-        if not self.registry:
-            missing_vars.append('ALIYUN_REGISTRY')
+        if missing_vars:
+            lines = "".join(f"\n  - {var}" for var in missing_vars)
+            raise ConfigError(f"缺少以下环境变量:{lines}\n请在.env文件中设置这些变量或直接在环境中设置")
 
-        self.namespace = os.getenv('ALIYUN_NAME_SPACE')
-        if not self.namespace:
-            missing_vars.append('ALIYUN_NAME_SPACE')
+        # 目标镜像名的固定部分，整个运行期间不变
+        self._dest_prefix = f"{self.registry}/{self.namespace}/"
 
-        self.username = os.getenv('ALIYUN_REGISTRY_USER')
-        if not self.username:
-            missing_vars.append('ALIYUN_REGISTRY_USER')
+    def load_parallel(self) -> int:
+        """从环境变量 MIRROR_PARALLEL 读取并发数"""
+        value = os.getenv('MIRROR_PARALLEL')
+        if not value:
+            return self.DEFAULT_PARALLEL
+        try:
+            parallel = int(value)
+        except ValueError:
+            parallel = 0
+        if parallel < 1:
+            logger.warning(f"MIRROR_PARALLEL 值无效: {value}，使用默认值 {self.DEFAULT_PARALLEL}")
+            return self.DEFAULT_PARALLEL
+        return parallel
+
+    def run_command(self, command: List[str], input_text: Optional[str] = None) -> subprocess.CompletedProcess:
+        """运行命令并返回结果，失败时抛出 CalledProcessError"""
+        return subprocess.run(
+            command,
+            check=True,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            input=input_text
+        )
 
-        self.password = os.getenv('ALIYUN_REGISTRY_PASSWORD')
-        if not self.password:
-            missing_vars.append('ALIYUN_REGISTRY_PASSWORD')
+    def detect_buildx(self) -> bool:
+        """检查本机是否安装了 docker buildx 插件"""
+        try:
+            self.run_command(["docker", "buildx", "version"])
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return True
+
+    def consume_stream(self, stream: Iterable[Dict[str, Any]], action: str) -> None:
+        """消费Docker API返回的JSON流，定期输出传输进度，遇到错误时抛出异常"""
+        # 每层已传输与总字节数
+        layers: Dict[str, Tuple[int, int]] = {}
+        done: Set[str] = set()
+        last_report = time.monotonic()
+        # 最近一次收到数据的时间，供看门狗线程判断传输是否停滞
+        last_chunk = [last_report]
+        stop = threading.Event()
+
+        def summary() -> str:
+            values = list(layers.values())
+            total = sum(t for _, t in values)
+            if not total:
+                return "尚未开始传输"
+            current = sum(c for c, _ in values)
+            return (f"{100 * current / total:.0f}% "
+                    f"({current / 1024 ** 2:.1f}/{total / 1024 ** 2:.1f} MB)，已完成 {len(done)} 层")
+
+        def watchdog() -> None:
+            # 停滞的传输不会再产生数据，只能由单独的线程定时检查
+            while not stop.wait(self.STALL_TIMEOUT):
+                idle = time.monotonic() - last_chunk[0]
+                if idle >= self.STALL_TIMEOUT:
+                    logger.warning(f"{action}: 已 {idle:.0f} 秒无进展，{summary()}")
+
+        threading.Thread(target=watchdog, name="stream-watchdog", daemon=True).start()
+        try:
+            for chunk in stream:
+                last_chunk[0] = time.monotonic()
+                if 'error' in chunk:
+                    raise APIError(f"{action}失败: {chunk['error']}")
+                status = chunk.get('status')
+                layer = chunk.get('id')
+                if not layer:
+                    if status:
+                        logger.debug(f"{action}: {status}")
+                    continue
 
-        if missing_vars:
-            logger.error("缺少以下环境变量:")
-            for var in missing_vars:
-                logger.error(f"  - {var}")
-            logger.error("请在.env文件中设置这些变量或直接在环境中设置")
-            sys.exit(1)
-
-    def run_command(self, command: List[str], check: bool = True, input_text: Optional[str] = None) -> subprocess.CompletedProcess:
-        """运行命令并返回结果"""
+                detail = chunk.get('progressDetail') or {}
+                if status in self.LAYER_TRANSFER_STATUSES and detail.get('total'):
+                    layers[layer] = (detail.get('current', 0), detail['total'])
+                elif status in self.LAYER_DONE_STATUSES:
+                    done.add(layer)
+                    if layer in layers:
+                        layers[layer] = (layers[layer][1], layers[layer][1])
+
+                # 限制输出频率
+                now = time.monotonic()
+                if layers and now - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = now
+                    logger.info(f"{action}: {summary()}")
+        finally:
+            stop.set()
+
+    def has_local_image(self, image: str, platform: str = "") -> bool:
+        """检查本地是否已存在该镜像，且平台与指定平台（未指定时为守护进程默认平台）一致"""
         try:
-            result = subprocess.run(
-                command,
-                check=check,
-                text=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                input=input_text
-            )
-            return result
-        except subprocess.CalledProcessError as e:
-            logger.error(f"命令执行失败: {' '.join(command)}")
-            logger.error(f"错误信息: {e.stderr}")
-            if check:
-                sys.exit(1)
-            raise
+            local = self.client.images.get(image)
+        except ImageNotFound:
+            return False
+
+        # 多平台索引的摘要对应多个平台，本地镜像只是其中之一
+        os_name, _, arch = (platform or self._get_daemon_platform()).partition('/')
+        arch, _, variant = arch.partition('/')
+        attrs = local.attrs
+        if attrs.get('Os') != os_name or attrs.get('Architecture') != arch:
+            return False
+        return not variant or attrs.get('Variant') == variant
+
+    def remove_image(self, image: str, force: bool = True) -> None:
+        """删除本地镜像，失败时仅记录警告"""
+        try:
+            self.client.images.remove(image, force=force)
+        except ImageNotFound:
+            pass
+        except APIError as e:
+            logger.warning(f"删除镜像 {image} 失败: {e}")
+
+    def check_daemon_config(self) -> None:
+        """检查Docker守护进程的并发传输配置，过低时给出调优提示"""
+        info = self.client.info()
+        self._docker_root = info.get('DockerRootDir', '/var/lib/docker')
+
+        # Docker API 不返回并发传输配置，只能读取本机（unix socket）守护进程的 daemon.json
+        if not sys.platform.startswith('linux') or self.client.api.base_url != 'http+docker://localhost':
+            return
+        try:
+            with open(self.DAEMON_CONFIG, 'r') as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        except (OSError, ValueError) as e:
+            logger.debug(f"无法读取 {self.DAEMON_CONFIG}: {e}")
+            return
+
+        for key, default in self.DAEMON_TRANSFER_DEFAULTS.items():
+            value = config.get(key, default)
+            if isinstance(value, int) and value < self.RECOMMENDED_CONCURRENT_TRANSFERS:
+                suffix = "（默认值）" if key not in config else ""
+                action = "拉取" if "downloads" in key else "推送"
+                logger.warning(
+                    f"{key}={value}{suffix}，建议在 {self.DAEMON_CONFIG} 中设置为 "
+                    f"{self.RECOMMENDED_CONCURRENT_TRANSFERS} 以加快{action}"
+                )
+
+    def _low_disk(self) -> bool:
+        """检查Docker数据目录的剩余空间是否低于阈值"""
+        if self._docker_root is None:
+            self._docker_root = self.client.info().get('DockerRootDir', '/var/lib/docker')
+        try:
+            return shutil.disk_usage(self._docker_root).free < self.MIN_FREE_BYTES
+        except OSError:
+            # 数据目录不在本机（如 Docker Desktop 虚拟机）时无法检查
+            return False
+
+    def _schedule_removal(self, *images: str) -> None:
+        """登记待删除的镜像，数量达到批次大小或磁盘空间不足时统一清理"""
+        with self._remove_lock:
+            self._to_remove.update(images)
+            pending = len(self._to_remove)
+        if pending >= self.REMOVE_BATCH_SIZE or self._low_disk():
+            self._flush_removals()
+
+    def _flush_removals(self) -> None:
+        """一次性删除所有待删除的镜像"""
+        with self._remove_lock:
+            images, self._to_remove = self._to_remove, set()
+        if not images:
+            return
+        logger.info(f"清理 {len(images)} 个镜像以释放空间")
+        for image in images:
+            self.remove_image(image)
+
+    def _resolve_reference(self, image: str) -> Tuple[str, str, str]:
+        """解析镜像引用，返回 (仓库地址, 仓库路径, 标签或摘要)"""
+        repository, reference = docker.utils.parse_repository_tag(image)
+        # nginx:1.25@sha256:... 按摘要定位，需要去掉仓库名中的标签
+        if reference and reference.startswith('sha256:') and ':' in repository.rsplit('/', 1)[-1]:
+            repository = repository.rsplit(':', 1)[0]
+        registry, repo = docker.auth.resolve_repository_name(repository)
+        if registry == docker.auth.INDEX_NAME:
+            # Docker Hub 的API地址与官方镜像的library命名空间
+            registry = "registry-1.docker.io"
+            if '/' not in repo:
+                repo = f"library/{repo}"
+        return registry, repo, reference or "latest"
+
+    def _fetch_token(self, registry: str, repo: str, challenge: str) -> Optional[str]:
+        """根据 WWW-Authenticate 响应头获取Bearer token"""
+        if not challenge.lower().startswith("bearer "):
+            return None
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if not realm:
+            return None
+        params.setdefault("scope", f"repository:{repo}:pull")
+
+        # 目标仓库使用阿里云凭据，其它仓库（如 Docker Hub）匿名获取
+        auth = (self.username, self.password) if registry == self.registry else None
+        resp = self._http.get(realm, params=params, auth=auth, timeout=self.REGISTRY_TIMEOUT)
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        token = data.get("token") or data.get("access_token")
+        if token:
+            ttl = min(int(data.get("expires_in") or self.TOKEN_TTL), self.TOKEN_TTL)
+            self._tokens[(registry, repo)] = (token, time.monotonic() + ttl)
+        return token
+
+    def _cached_token(self, registry: str, repo: str) -> Optional[str]:
+        """返回未过期的缓存token"""
+        cached = self._tokens.get((registry, repo))
+        if not cached or cached[1] <= time.monotonic():
+            return None
+        return cached[0]
+
+    def _registry_request(self, method: str, registry: str, repo: str, reference: str) -> requests.Response:
+        """请求镜像清单，必要时自动获取token并重试"""
+        url = f"https://{registry}/v2/{repo}/manifests/{reference}"
+        headers = {"Accept": ", ".join(self.MANIFEST_TYPES)}
+        token = self._cached_token(registry, repo)
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+
+        resp = self._http.request(method, url, headers=headers, allow_redirects=True, timeout=self.REGISTRY_TIMEOUT)
+        if resp.status_code == 401:
+            token = self._fetch_token(registry, repo, resp.headers.get("WWW-Authenticate", ""))
+            if token:
+                headers["Authorization"] = f"Bearer {token}"
+                resp = self._http.request(method, url, headers=headers, allow_redirects=True, timeout=self.REGISTRY_TIMEOUT)
+        return resp
+
+    def _remote_digest(self, registry: str, repo: str, reference: str) -> Optional[Tuple[str, str]]:
+        """通过HEAD请求获取远程镜像清单的摘要，返回 (摘要, 清单类型)"""
+        resp = self._registry_request("HEAD", registry, repo, reference)
+        digest = resp.headers.get("Docker-Content-Digest")
+        if resp.status_code != 200 or not digest:
+            return None
+        content_type = resp.headers.get("Content-Type", "").split(";")[0].strip()
+        return digest, content_type
+
+    def _platform_digest(self, registry: str, repo: str, reference: str, platform: str) -> Optional[str]:
+        """从多平台索引中查找指定平台的清单摘要"""
+        resp = self._registry_request("GET", registry, repo, reference)
+        if resp.status_code != 200:
+            return None
+        os_name, _, arch = platform.partition('/')
+        arch, _, variant = arch.partition('/')
+        for manifest in resp.json().get("manifests", []):
+            target = manifest.get("platform", {})
+            if target.get("os") != os_name or target.get("architecture") != arch:
+                continue
+            if variant and target.get("variant") != variant:
+                continue
+            return manifest.get("digest")
+        return None
+
+    def _config_digest(self, registry: str, repo: str, reference: str) -> Optional[str]:
+        """获取单平台镜像清单中 config 的摘要，即镜像ID"""
+        resp = self._registry_request("GET", registry, repo, reference)
+        if resp.status_code != 200:
+            return None
+        return (resp.json().get("config") or {}).get("digest")
+
+    def _get_daemon_platform(self) -> str:
+        """获取Docker守护进程的默认平台，例如 linux/amd64"""
+        if self._daemon_platform is None:
+            version = self.client.version()
+            self._daemon_platform = f"{version.get('Os', 'linux')}/{version.get('Arch', 'amd64')}"
+        return self._daemon_platform
+
+    def _already_mirrored(self, spec: ImageSpec, new_image: str) -> bool:
+        """检查目标镜像是否已存在且与源镜像内容一致"""
+        try:
+            dest = self._remote_digest(*self._resolve_reference(new_image))
+            if not dest:
+                return False
+            source_ref = self._resolve_reference(spec.image)
+            source = self._remote_digest(*source_ref)
+            if not source:
+                return False
+            # buildx 复制会原样保留清单，摘要相同即内容相同
+            if source[0] == dest[0]:
+                return True
+            if dest[1] in self.MANIFEST_LIST_TYPES:
+                return False
+
+            # 拉取推送时守护进程会重新生成清单（例如 OCI 清单转为 Docker schema2），
+            # 清单摘要不同，但镜像 config 的摘要（镜像ID）保持不变
+            registry, repo, reference = source_ref
+            if source[1] in self.MANIFEST_LIST_TYPES:
+                # 源镜像为多平台索引时，只推送了其中一个平台
+                platform = spec.platform or self._get_daemon_platform()
+                reference = self._platform_digest(registry, repo, reference, platform)
+                if not reference:
+                    return False
+                if reference == dest[0]:
+                    return True
+            source_config = self._config_digest(registry, repo, reference)
+            return bool(source_config) and source_config == self._config_digest(*self._resolve_reference(new_image))
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"检查镜像 {spec.image} 的远程摘要失败: {e}")
+        return False
 
     def docker_login(self) -> None:
         """登录到阿里云容器镜像服务"""
         logger.info(f"登录到阿里云容器镜像服务: {self.registry}")
 
-        # 使用subprocess执行docker login命令
-        result = self.run_command(
-            ["docker", "login",
-             "-u", self.username,
-             "--password-stdin",
-             self.registry],
-            input_text=self.password
-        )
-
-        if result.returncode != 0:
-            logger.error("登录失败，请检查凭据")
-            logger.error(f"错误信息: {result.stderr}")
-            sys.exit(1)
+        try:
+            self.client.login(
+                username=self.username,
+                password=self.password,
+                registry=self.registry,
+                reauth=True
+            )
+        except APIError as e:
+            raise MirrorRuntimeError(f"登录失败，请检查凭据\n错误信息: {e}") from e
+
+        # buildx 读取的是 docker CLI 的凭据，需要单独登录一次
+        if self.use_buildx:
+            try:
+                self.run_command(
+                    ["docker", "login",
+                     "-u", self.username,
+                     "--password-stdin",
+                     self.registry],
+                    input_text=self.password
+                )
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"docker CLI 登录失败，改用拉取推送方式: {e.stderr.strip()}")
+                self.use_buildx = False
 
         logger.info("登录成功")
 
-    def preprocess_images(self) -> None:
-        """预处理镜像列表，检测重名镜像"""
-        if not Path(self.images_file).exists():
-            logger.error(f"镜像列表文件 {self.images_file} 不存在")
-            sys.exit(1)
+    def _parse_images(self) -> List[ImageSpec]:
+        """解析镜像列表文件，整个文件只读取、解析一次"""
+        if self._specs is not None:
+            return self._specs
+
+        images_path = Path(self.images_file)
+        if not images_path.exists():
+            raise ConfigError(f"镜像列表文件 {self.images_file} 不存在")
+
+        specs: List[ImageSpec] = []
+        # 已出现过的 (平台, 镜像)，同一镜像只处理一次
+        seen: Set[Tuple[str, str]] = set()
+        for line in images_path.read_text(encoding='utf-8').splitlines():
+            line = line.strip()
+
+            # 忽略空行与注释
+            if not line or line.startswith('#'):
+                continue
+
+            # 解析平台信息，大多数行不带平台参数，先用子串判断跳过正则
+            platform = ""
+            if '--platform' in line:
+                platform_match = self._PLATFORM_RE.search(line)
+                if platform_match:
+                    platform = platform_match.group(1)
+
+            # 获取镜像的完整名称（最后一个参数）
+            image = line.split()[-1]
+
+            if (platform, image) in seen:
+                logger.debug(f"跳过重复行: {line}")
+                continue
+            seen.add((platform, image))
+
+            # 获取镜像名:版本号，并将@sha256:等字符删除
+            parts = image.split('/')
+            image_name_tag = parts[-1].split('@')[0]
+
+            # 获取命名空间
+            name_space = parts[1] if len(parts) == 3 else parts[0] if len(parts) == 2 else ""
+
+            # 获取镜像名
+            image_name = image_name_tag.split(':')[0]
+
+            specs.append(ImageSpec(
+                raw=line,
+                image=image,
+                platform=platform,
+                parts=parts,
+                image_name_tag=image_name_tag,
+                image_name=image_name,
+                name_space=name_space,
+                # 如果存在架构信息 将架构信息拼到镜像名称前面
+                platform_prefix=f"{platform.replace('/', '_')}_" if platform else "",
+            ))
+        self._specs = specs
+        return specs
 
+    def preprocess_images(self, specs: List[ImageSpec]) -> None:
+        """预处理镜像列表，检测重名镜像"""
         logger.info("开始处理镜像列表")
 
         # 用于检测重名的临时映射
         temp_map: Dict[str, str] = {}
 
-        with open(self.images_file, 'r') as f:
-            for line in f:
-                line = line.strip()
+        for spec in specs:
+            logger.info(f"处理镜像: {spec.image.split('@')[0]}")
+            logger.debug(f"镜像名:版本号: {spec.image_name_tag}")
+            logger.debug(f"命名空间: {spec.name_space}")
+            logger.debug(f"镜像名: {spec.image_name}")
 
-                # 忽略空行与注释
-                if not line or line.startswith('#'):
-                    continue
+            # 这里不要是空值影响判断
+            name_space = f"{spec.name_space}_"
 
-                # 获取镜像的完整名称
-                image = line.split()[-1]
-
-                # 将@sha256:等字符删除
-                image = image.split('@')[0]
-                logger.info(f"处理镜像: {image}")
-
-                # 获取镜像名:版本号
-                parts = image.split('/')
-                image_name_tag = parts[-1]
-                logger.info(f"镜像名:版本号: {image_name_tag}")
-
-                # 获取命名空间
-                if len(parts) == 3:
-                    name_space = parts[1]
-                elif len(parts) == 2:
-                    name_space = parts[0]
-                else:
-                    name_space = ""
-                logger.info(f"命名空间: {name_space}")
-
-                # 这里不要是空值影响判断
-                name_space = f"{name_space}_"
-
-                # 获取镜像名
-                image_name = image_name_tag.split(':')[0]
-                logger.info(f"镜像名: {image_name}")
-
-                # 检查是否重名
-                if image_name in temp_map:
-                    if temp_map[image_name] != name_space:
-                        logger.warning(f"发现重复的镜像名: {image_name}")
-                        self.duplicate_images.add(image_name)
-                else:
-                    temp_map[image_name] = name_space
-
-    def process_images(self) -> None:
-        """处理镜像：拉取、标记、推送到阿里云"""
-        logger.info("开始拉取和推送镜像")
-
-        with open(self.images_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-
-                # 忽略空行与注释
-                if not line or line.startswith('#'):
-                    continue
+            # 检查是否重名
+            if spec.image_name in temp_map:
+                if temp_map[spec.image_name] != name_space:
+                    logger.warning(f"发现重复的镜像名: {spec.image_name}")
+                    self.duplicate_images.add(spec.image_name)
+            else:
+                temp_map[spec.image_name] = name_space
 
-                # 解析平台信息
-                platform_match = re.search(r'--platform[ =]([^\s]+)', line)
-                platform = platform_match.group(1) if platform_match else ""
+        # 镜像名重名且命名空间非空时，将命名空间加到前缀
+        for spec in specs:
+            if spec.image_name in self.duplicate_images and spec.name_space:
+                spec.name_space_prefix = f"{spec.name_space}_"
 
-                # 获取镜像名称（最后一个参数）
-                image = line.split()[-1]
+    def process_images(self, specs: List[ImageSpec]) -> None:
+        """处理镜像：并发拉取、标记、推送到阿里云"""
+        logger.info(f"开始拉取和推送镜像，并发数: {self.parallel}")
 
-                # 构建docker pull命令
-                pull_cmd = ["docker", "pull"]
-                if platform:
-                    # 如果有平台参数，添加到命令中
-                    pull_cmd.extend(["--platform", platform])
-                pull_cmd.append(image)
+        # 记录处理失败的镜像，单个镜像失败不影响其他镜像
+        if self.parallel == 1:
+            failed = self._run_pipeline(specs)
+        else:
+            failed = self._run_pool(specs)
 
-                logger.info(f"拉取镜像: {' '.join(pull_cmd)}")
-                self.run_command(pull_cmd)
+        self._flush_removals()
 
-                logger.info(f"平台架构: {platform}")
+        if failed:
+            lines = "".join(f"\n  - {line}" for line, _ in failed)
+            raise MirrorRuntimeError(f"共 {len(failed)} 个镜像处理失败:{lines}")
 
-                # 如果存在架构信息 将架构信息拼到镜像名称前面
-                if not platform:
-                    platform_prefix = ""
-                else:
-                    platform_prefix = f"{platform.replace('/', '_')}_"
-                logger.info(f"平台前缀: {platform_prefix}")
-
-                # 获取镜像名:版本号
-                parts = image.split('/')
-                image_name_tag = parts[-1]
-
-                # 获取命名空间
-                if len(parts) == 3:
-                    name_space = parts[1]
-                elif len(parts) == 2:
-                    name_space = parts[0]
-                else:
-                    name_space = ""
-
-                # 获取镜像名
-                image_name = image_name_tag.split(':')[0]
-
-                name_space_prefix = ""
-                # 如果镜像名重名
-                if image_name in self.duplicate_images:
-                    # 如果命名空间非空，将命名空间加到前缀
-                    if name_space:
-                        name_space_prefix = f"{name_space}_"
-
-                # 将@sha256:等字符删除
-                image_name_tag = image_name_tag.split('@')[0]
-                new_image = f"{self.registry}/{self.namespace}/{platform_prefix}{name_space_prefix}{image_name_tag}"
-
-                logger.info(f"标记镜像: docker tag {image} {new_image}")
-                self.run_command(["docker", "tag", image, new_image])
-
-                logger.info(f"推送镜像: docker push {new_image}")
-                self.run_command(["docker", "push", new_image])
-
-                logger.info("清理镜像以释放空间")
-                self.run_command(["docker", "rmi", image], check=False)
-                self.run_command(["docker", "rmi", new_image], check=False)
+        logger.info("所有镜像处理完成")
 
+    def _run_pool(self, specs: List[ImageSpec]) -> List[Tuple[str, BaseException]]:
+        """使用线程池并发处理镜像，返回处理失败的镜像"""
+        failed: List[Tuple[str, BaseException]] = []
+        executor = ThreadPoolExecutor(max_workers=self.parallel)
+        try:
+            futures = {executor.submit(self._mirror_one, spec): spec for spec in specs}
+            for future in as_completed(futures):
+                line = futures[future].raw
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"镜像 {line} 处理失败: {e}")
+                    failed.append((line, e))
+        except KeyboardInterrupt:
+            # 用户中断时取消排队中的镜像，不等待它们执行完
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return failed
+
+    def _run_pipeline(self, specs: List[ImageSpec]) -> List[Tuple[str, BaseException]]:
+        """拉取与推送两级流水线：后台线程拉取下一个镜像的同时推送当前镜像"""
+        failed: List[Tuple[str, BaseException]] = []
+        # 已拉取并标记为目标镜像、待推送的镜像，None 表示拉取结束
+        pull_q: "queue.Queue[Optional[Tuple[ImageSpec, str]]]" = queue.Queue(maxsize=2)
+
+        def puller_loop() -> None:
+            try:
+                for spec in specs:
+                    try:
+                        new_image = self._pull_stage(spec)
+                    except Exception as e:
+                        logger.error(f"镜像 {spec.raw} 处理失败: {e}")
+                        failed.append((spec.raw, e))
+                        continue
+                    if new_image:
+                        pull_q.put((spec, new_image))
+            finally:
+                pull_q.put(None)
+
+        puller = threading.Thread(target=puller_loop, name="puller", daemon=True)
+        puller.start()
+        while True:
+            item = pull_q.get()
+            if item is None:
+                break
+            spec, new_image = item
+            try:
+                self._push_stage(spec, new_image)
+            except Exception as e:
+                logger.error(f"镜像 {spec.raw} 处理失败: {e}")
+                failed.append((spec.raw, e))
+        puller.join()
+        return failed
+
+    def _mirror_one(self, spec: ImageSpec) -> None:
+        """处理单个镜像：拉取、标记、推送、清理"""
+        new_image = self._pull_stage(spec)
+        if new_image:
+            self._push_stage(spec, new_image)
+
+    def _source_lock(self, image: str) -> threading.Lock:
+        """获取源镜像对应的锁，nginx 与 docker.io/library/nginx:latest 共用一把锁"""
+        key = self._resolve_reference(image)
+        with self._source_locks_guard:
+            return self._source_locks.setdefault(key, threading.Lock())
+
+    def _pull_stage(self, spec: ImageSpec) -> Optional[str]:
+        """拉取阶段：拉取并标记为目标镜像，返回目标镜像名；无需推送时返回 None"""
+        image = spec.image
+        platform = spec.platform
+
+        logger.debug(f"平台架构: {platform}")
+        logger.debug(f"平台前缀: {spec.platform_prefix}")
+
+        new_image = "".join((self._dest_prefix, spec.platform_prefix, spec.name_space_prefix, spec.image_name_tag))
+
+        if self._already_mirrored(spec, new_image):
+            logger.info(f"跳过镜像 {image}: 已同步到 {new_image}")
+            return None
+
+        # 未指定平台时直接在仓库之间复制，保留多平台索引且不占用本地磁盘
+        if not platform and self.use_buildx:
+            logger.info(f"复制镜像: {image} -> {new_image}")
+            try:
+                self.run_command(["docker", "buildx", "imagetools", "create", "--tag", new_image, image])
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"复制镜像 {image} 失败，改用拉取推送方式: {e.stderr.strip()}")
+            else:
                 logger.info(f"镜像 {image} 处理完成，已推送到 {new_image}")
+                return None
+
+        # 多个线程可能同时拉取同一标签（例如不同平台），拉取到标记完成之前不能被其它线程覆盖
+        pinned = '@sha256:' in image
+        with self._source_lock(image):
+            # 按摘要固定的镜像内容不可变，本地已有相同平台的镜像时无需重新拉取
+            if pinned and self.has_local_image(image, platform):
+                logger.info(f"使用本地缓存镜像: {image}")
+            else:
+                logger.info(f"拉取镜像: {image}")
+                self.consume_stream(
+                    self.client.api.pull(image, platform=platform or None, stream=True, decode=True),
+                    f"拉取镜像 {image}"
+                )
+
+            # 拉取后立即标记为目标镜像并取消源镜像的标签。源镜像名可能被后续拉取
+            # （例如同一标签的其它平台）覆盖，之后的推送只使用目标镜像名。
+            # 开启 MIRROR_KEEP_PINNED 时保留按摘要固定的源镜像，磁盘空间不足时仍然清理
+            logger.debug(f"标记镜像: {image} -> {new_image}")
+            repository, tag = docker.utils.parse_repository_tag(new_image)
+            self.client.images.get(image).tag(repository, tag or "latest")
+            if not (pinned and self.keep_pinned and not self._low_disk()):
+                self.remove_image(image, force=False)
+        return new_image
+
+    def _push_stage(self, spec: ImageSpec, new_image: str) -> None:
+        """推送阶段：推送已标记的目标镜像并登记待清理"""
+        image = spec.image
+        # 未指定标签时必须显式推送 latest，否则会推送该仓库的所有本地标签
+        repository, tag = docker.utils.parse_repository_tag(new_image)
+        tag = tag or "latest"
+
+        logger.info(f"推送镜像: {new_image}")
+        self.consume_stream(
+            self.client.images.push(repository, tag, stream=True, decode=True),
+            f"推送镜像 {new_image}"
+        )
 
-        logger.info("所有镜像处理完成")
+        self._schedule_removal(new_image)
+
+        logger.info(f"镜像 {image} 处理完成，已推送到 {new_image}")
 
     def run(self) -> None:
         """运行Docker镜像镜像工具"""
         logger.info("Docker镜像镜像工具启动")
+        self.use_buildx = self.detect_buildx()
+        if not self.use_buildx:
+            logger.info("未检测到 docker buildx，将通过本地拉取推送同步镜像")
+        self.check_daemon_config()
         self.docker_login()
-        self.preprocess_images()
-        self.process_images()
+        specs = self._parse_images()
+        self.preprocess_images(specs)
+        self.process_images(specs)
         logger.info("任务完成")
 
+def parse_args() -> argparse.Namespace:
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="Docker镜像镜像工具")
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=None,
+        help=f"并发处理的镜像数量，默认读取环境变量 MIRROR_PARALLEL，未设置时为 {DockerMirror.DEFAULT_PARALLEL}"
+    )
+    args = parser.parse_args()
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel 必须为正整数")
+    return args
+
 def main():
     """主函数"""
+    args = parse_args()
     try:
-        mirror = DockerMirror()
+        mirror = DockerMirror(parallel=args.parallel)
         mirror.run()
     except KeyboardInterrupt:
         logger.info("用户中断，退出程序")
         sys.exit(0)
+    except MirrorError as e:
+        logger.error(str(e))
+        sys.exit(1)
     except Exception as e:
         logger.error(f"发生错误: {str(e)}")
         sys.exit(1)